@@ -2,6 +2,8 @@ import os
 import sys
 import h5py
 import ast 
+import functools
+import hashlib
 
 import cProfile
 import pstats
@@ -27,14 +29,16 @@ import spherical, quaternionic
 import pyuvsim
 
 # Hydra
-sys.path.append("/cosma8/data/dp270/dc-glas1/Hydra") # change this to your own path
+# Set HYDRA_PATH to your own path, if Hydra isn't installed
+sys.path.append(os.environ.get("HYDRA_PATH", "/cosma8/data/dp270/dc-glas1/Hydra"))
 import hydra
 from hydra.utils import build_hex_array
 
 import argparse
 
 # Linear solver 
-from scipy.sparse.linalg import cg, LinearOperator
+from scipy.sparse.linalg import LinearOperator
+from scipy.linalg import get_blas_funcs, cho_factor, cho_solve, eigh
 
 # All things astropy
 from astropy import units
@@ -52,9 +56,6 @@ import time
 # Multiprocessing
 from multiprocessing import Pool
 
-# Printing full arrays
-np.set_printoptions(threshold=sys.maxsize)
-
 # Construct the argument parser
 AP = argparse.ArgumentParser()
 
@@ -71,7 +72,7 @@ AP.add_argument("-jobid", "--jobid", required=False,
         help="array job id")
 
 AP.add_argument("-profile", "--profile", type=str, required=False,
-        help="Toggles whether cProfile is enabled, boolean")
+        help="Toggles whether cProfile is enabled, boolean. Only applies to single-chain runs")
 
 AP.add_argument("-tol", "--tolerance", required=False,
         help="Sets the tolerance for the conjugate gradient solver for the alm-samples")
@@ -118,6 +119,18 @@ AP.add_argument("-include_RSB", "--include_RSB", type=str, required=False,
 AP.add_argument("-front_factor", "--a_00_front_factor", type=float, required=False,
         help="change the constraint from the prior_variance on the monopole specifically. Float.")
 
+AP.add_argument("-precision", "--precision", type=str, required=False,
+        help="fp32 or fp64. Precision of the solver for the alm-samples, fp32 is refined to the tolerance in fp64. Defaults to fp64")
+
+AP.add_argument("-dense_max", "--dense_max_size", type=int, required=False,
+        help="Int. Largest number of modes for which the alm-samples are solved directly (Cholesky) instead of with CG. Defaults to 4096")
+
+AP.add_argument("-nchains", "--number_of_chains", type=int, required=False,
+        help="Int. Number of independent Gibbs chains, run in parallel. Defaults to 1")
+
+AP.add_argument("-cache_dir", "--cache_dir", required=False,
+        help="directory for caching precomputed quantities between runs. Defaults to no caching")
+
 ARGS = vars(AP.parse_args())
 
 ## Functions
@@ -179,60 +192,44 @@ def vis_proj_operator_no_rot(freqs, lsts, beams, ant_pos, lmax, nside, latitude=
                                                                beams=beams,
                                                                latitude=latitude)
     
-    # Removing visibility responses corresponding to the m=0 imaginary parts 
-    vis_alm = np.concatenate((vis_alm[:,:,:,:,:len(ell)],vis_alm[:,:,:,:,len(ell)+(lmax+1):]), axis=4)
+    # Removing visibility responses corresponding to the m=0 imaginary parts. This is 
+    # done as part of the baseline gather below, to avoid copying the full vis_alm array
+    keep_idx = np.r_[0:len(ell), len(ell)+(lmax+1):vis_alm.shape[-1]]
     
-    ants = list(ant_pos.keys())
-    antpairs = []
-    if autos_only == False and include_autos == False:
-        auto_ants = []
-    for i in ants:
-        for j in ants:
-            # Toggle via keyword argument if you want to keep the auto baselines/only have autos
-            if include_autos == True:
-                if j >= i:
-                    antpairs.append((ants[i],ants[j]))
-            elif autos_only == True:
-                if j == i:
-                    antpairs.append((ants[i],ants[j]))
-            else:
-                if j == i:
-                    auto_ants.append((ants[i],ants[j]))
-                if j > i:
-                    antpairs.append((ants[i],ants[j]))
-                
-    vis_response = np.zeros((len(antpairs),len(freqs),len(lsts),2*len(ell)-(lmax+1)), dtype=np.complex128)
-    # vis_response = np.zeros((len(antpairs),*vis_alm.shape[:-3],2*len(ell)-lmax), dtype=np.complex128)
+    # Baselines as positional indices into the antenna axes of vis_alm, ordered as (i, j>=i)
+    nants = len(ant_pos)
+    # Toggle via keyword argument if you want to keep the auto baselines/only have autos
+    if include_autos == True:
+        ant_i, ant_j = np.triu_indices(nants, k=0)
+    elif autos_only == True:
+        ant_i = ant_j = np.arange(nants)
+    else:
+        ant_i, ant_j = np.triu_indices(nants, k=1)
+        auto_idx = np.arange(nants)
     
+    # Broadcast index arrays for the freq and time axes, so a single gather returns a 
+    # C-contiguous (Nbl, Nfreqs, Ntimes, Nalms) array which reshapes to 2D without a copy
+    freq_idx = np.arange(vis_alm.shape[0])[:,None,None]
+    time_idx = np.arange(vis_alm.shape[1])[:,None]
+
     ## Collapse the two antenna dimensions into one baseline dimension
     # Nfreqs, Ntimes, Nant1, Nant2, Nalms --> Nbl, Nfreqs, Ntimes, Nalms 
-    for i, bl in enumerate(antpairs):
-        idx1 = ants.index(bl[0])
-        idx2 = ants.index(bl[1])
-        vis_response[i, :] = vis_alm[:, :, idx1, idx2, :]  
+    vis_response = vis_alm[freq_idx, time_idx, ant_i[:,None,None,None], ant_j[:,None,None,None], keep_idx]
         
     ## Reshape to 2D                                      ## TODO: Make this into a "pack" and "unpack" function
     # Nbl, Nfreqs, Ntimes, Nalms --> Nvis, Nalms
-    Nvis = len(antpairs) * len(freqs) * len(lsts)
-    # Nvis = np.prod([len(antpairs),*vis_alm.shape[:-3]])
-    vis_response_2D = vis_response.reshape(Nvis, 2*len(ell)-(lmax+1))
+    vis_response_2D = vis_response.reshape(-1, keep_idx.size)
     
     
     
     if autos_only == False and include_autos == False:
-        autos = np.zeros((len(auto_ants),len(freqs),len(lsts),2*len(ell)-(lmax+1)), dtype=np.complex128)
         ## Collapse the two antenna dimensions into one baseline dimension
         # Nfreqs, Ntimes, Nant1, Nant2, Nalms --> Nbl, Nfreqs, Ntimes, Nalms 
-        for i, bl in enumerate(auto_ants):
-            idx1 = ants.index(bl[0])
-            idx2 = ants.index(bl[1])
-            autos[i, :] = vis_alm[:, :, idx1, idx2, :]   
+        autos = vis_alm[freq_idx, time_idx, auto_idx[:,None,None,None], auto_idx[:,None,None,None], keep_idx]
 
         ## Reshape to 2D                                      ## TODO: Make this into a "pack" and "unpack" function
         # Nbl, Nfreqs, Ntimes, Nalms --> Nvis, Nalms
-        Nautos = len(auto_ants) * len(freqs) * len(lsts)
-        # Nvis = np.prod([len(antpairs),*vis_alm.shape[:-3]])
-        autos_2D = autos.reshape(Nautos, 2*len(ell)-(lmax+1))
+        autos_2D = autos.reshape(-1, keep_idx.size)
 
     
     if autos_only == False and include_autos == False:
@@ -241,101 +238,118 @@ def vis_proj_operator_no_rot(freqs, lsts, beams, ant_pos, lmax, nside, latitude=
         return vis_response_2D, ell, m
 
 
-def get_em_ell_idx(lmax):
+def get_vis_proj_operator_cached(freqs, lsts, beams, ant_pos, lmax, nside, latitude, dish_diameter, cache_dir=None):
     """
-    Function to get the em, ell, and index of all the modes given the lmax. 
-    (m,l)-ordering, (m-major ordering)
+    Wrapper around vis_proj_operator_no_rot() (without autos in the main 
+    operator) which caches the operators on disk, keyed by the inputs, 
+    so the visibility simulation is skipped when they have already been computed.
+    The operators are cached as .npy files and memory-mapped (read-only) 
+    when loaded from the cache.
 
     Parameters
     ----------
-    * lmax: (int)
-        Maximum ell value for alms
+    * freqs, lsts, beams, ant_pos, lmax, nside, latitude: 
+            See vis_proj_operator_no_rot()
 
-    Returns
-    -------
-    * ems: (list (int))
-        List of all the em values of the alms (m,l)-ordering (m-major)
+    * dish_diameter (float):
+            Diameter of the (gaussian) beams. The pyuvbeam objects can't be 
+            hashed, so the beams are identified by the dish diameter in the key.
 
-    * ells: (list (int))
-        List of all the ell values of the alms (m,l)-ordering (m-major)
-        
-    * idx: (list (int)) 
-        List of all the indices for the alms
+    * cache_dir (optional) (str):
+            Directory to cache the operators in. If cache_dir=None (default): 
+            no caching.
 
+    Returns
+    -------
+    * vis_response_2D, autos_2D, ell, m: 
+            See vis_proj_operator_no_rot()
     """
+    if cache_dir is None:
+        return vis_proj_operator_no_rot(freqs=freqs, 
+                                        lsts=lsts, 
+                                        beams=beams, 
+                                        ant_pos=ant_pos, 
+                                        lmax=lmax, 
+                                        nside=nside,
+                                        latitude=latitude)
+
+    ant_key = [(ant, np.asarray(ant_pos[ant]).tolist()) for ant in ant_pos]
+    key = hashlib.sha1(repr((np.atleast_1d(freqs).tolist(), np.asarray(lsts).tolist(), ant_key, 
+                             lmax, nside, latitude, dish_diameter)).encode()).hexdigest()
+    cache_files = {name: os.path.join(cache_dir, f'vis_proj_{key}_{name}.npy') 
+                   for name in ('vis_response', 'autos', 'ell', 'm')}
+    # The ell file is written last, so the cache is complete if it exists
+    if os.path.exists(cache_files['ell']):
+        return (np.load(cache_files['vis_response'], mmap_mode='r'), 
+                np.load(cache_files['autos'], mmap_mode='r'),
+                np.load(cache_files['ell']), 
+                np.load(cache_files['m']))
 
-    ells_list = np.arange(0,lmax+1)
-    em_real = np.arange(0,lmax+1)
-    em_imag = np.arange(1,lmax+1)
-    
-    Nreal = 0
-    i = 0
-    idx = []
-    ems = []
-    ells = []
-
-    for em in em_real:
-        for ell in ells_list:
-            if ell >= em:
-                idx.append(i)
-                ems.append(em)
-                ells.append(ell)
-                
-                Nreal += 1
-                i +=1
-    
-    Nimag=0
-
-    for em in em_imag:
-        for ell in ells_list:
-            if ell >= em:
-                idx.append(i)
-                ems.append(em)
-                ells.append(ell)
-
-                Nimag += 1
-                i += 1
-
-    return ems, ells, idx
-
-def find_common_true_index(arr_em, arr_ell, lmax):
+    vis_response, autos, ell, m = vis_proj_operator_no_rot(freqs=freqs, 
+                                                            lsts=lsts, 
+                                                            beams=beams, 
+                                                            ant_pos=ant_pos, 
+                                                            lmax=lmax, 
+                                                            nside=nside,
+                                                            latitude=latitude)
+
+    # Write to temporary files first, so other jobs never read a partial cache file
+    for name, arr in (('vis_response', vis_response), ('autos', autos), ('m', m), ('ell', ell)):
+        tmp_file = f'{cache_files[name]}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp_file, cache_files[name])
+
+    return vis_response, autos, ell, m
+
+@functools.lru_cache(maxsize=None)
+def get_em_ell_idx(lmax):
     """
-    Find the common index between two arrays of same length consisting of true and false.
+    Function to get the em, ell, and index of all the modes given the lmax. 
+    (m,l)-ordering, (m-major ordering)
+    The result is cached per lmax, so the returned arrays are read-only.
 
     Parameters
     ----------
-    * arr1: (ndarray (boolean))
-        The first array to compare, consisting of true and false
-
-    * arr2: (ndarray (boolean))
-        The second array to compare, consisting of true and false
+    * lmax: (int)
+        Maximum ell value for alms
 
     Returns
     -------
-    * idx_real: (int)
-        The common index for the real part
+    * ems: (ndarray (int))
+        Array of all the em values of the alms (m,l)-ordering (m-major)
 
-    * idx_imag: (int)
-        The common index for the imag part
+    * ells: (ndarray (int))
+        Array of all the ell values of the alms (m,l)-ordering (m-major)
+        
+    * idx: (ndarray (int)) 
+        Array of all the indices for the alms
 
     """
-    real_imag_split_index = int(((lmax+1)**2 + (lmax+1))/2)
 
-    real_idx = []
-    imag_idx = []
+    # Real part: all ell >= em in m-major order, imag part: the same but without the m=0 modes
+    ems_real, ells_real = np.triu_indices(lmax+1)
+    mask_imag = ems_real >= 1
 
-    for idx in range(len(arr_em)):
-        if arr_em[idx] and arr_ell[idx] and idx < real_imag_split_index:
-            real_idx = idx
-        elif arr_em[idx] and arr_ell[idx] and idx >= real_imag_split_index:
-            imag_idx = idx
+    ems = np.concatenate((ems_real, ems_real[mask_imag]))
+    ells = np.concatenate((ells_real, ells_real[mask_imag]))
+    idx = np.arange(ems.size)
 
-    return real_idx, imag_idx
+    for arr in (ems, ells, idx):
+        arr.setflags(write=False)
+
+    return ems, ells, idx
 
 def get_idx_ml(em, ell, lmax):
     """
     Get the global index for the alms (m,l)-ordering (m-major) given a m 
     and ell value. 
+
+    The index is given by the triangular offsets of the m-major ordering in
+    get_em_ell_idx(): the real block holds (lmax+1-m') modes for every m' < m,
+    so real_idx = m*(lmax+1) - m*(m-1)/2 + (ell-m). The imag block starts 
+    after the Nreal = (lmax+1)*(lmax+2)/2 real modes and has no m=0 modes, 
+    so imag_idx = Nreal + (m-1)*(lmax+1) - (m-1)*m/2 + (ell-m).
     
     Parameters
     ----------
@@ -350,34 +364,34 @@ def get_idx_ml(em, ell, lmax):
 
     Returns
     -------
-    * common_idx_real: (int)
+    * real_idx: (int)
         The global index of the real part of the spherical harmonic mode
 
-    * common_idx_imag: (int)
-        The global index of the imaginary part of the spherical harmonic mode
+    * imag_idx: (int or None)
+        The global index of the imaginary part of the spherical harmonic mode.
+        None for the m=0 modes, as they have no imaginary part.
 
     """
 
     assert np.all(em <= ell), "m cannot be greater than the ell value"
-    ems_idx, ells_idx, idx = get_em_ell_idx(lmax)
 
-    em_check = np.array(ems_idx) == em
-    ell_check = np.array(ells_idx) == ell
+    real_idx = em*(lmax+1) - em*(em-1)//2 + (ell - em)
 
-    common_idx_real, common_idx_imag = find_common_true_index(arr_em=em_check,
-                                                              arr_ell=ell_check,
-                                                              lmax=lmax)
-    if common_idx_imag == []: # happens if m=0
-        idx_list = [common_idx_real]
+    if em == 0:
+        imag_idx = None
     else:
-        idx_list = [common_idx_real, common_idx_imag]
+        Nreal = (lmax+1)*(lmax+2)//2
+        imag_idx = Nreal + (em-1)*(lmax+1) - (em-1)*em//2 + (ell - em)
 
-    for common_idx in idx_list:
-        assert common_idx == idx[common_idx], "the global index does not match the index list"
-        assert em == ems_idx[common_idx], "The em corresponding to the global index does not match the chosen em"
-        assert ell == ells_idx[common_idx], "The ell corresponding to the global index does not match the vhosen ell"
+    if __debug__:
+        ems_idx, ells_idx, _ = get_em_ell_idx(lmax)
+        for common_idx in (real_idx, imag_idx):
+            if common_idx is None:
+                continue
+            assert em == ems_idx[common_idx], "The em corresponding to the global index does not match the chosen em"
+            assert ell == ells_idx[common_idx], "The ell corresponding to the global index does not match the chosen ell"
 
-    return common_idx_real, common_idx_imag
+    return real_idx, imag_idx
 
 def alms2healpy(alms, lmax):
     """
@@ -417,7 +431,8 @@ def healpy2alms(healpy_modes):
     """
     Takes a complex array of alms (positive modes only) and turns into
     a real array split as [real, imag] making sure to remove the 
-    m=0 modes from the imag-part.
+    m=0 modes from the imag-part. Several sets of modes can be stacked 
+    along the first axis.
       
     Parameters
     ----------
@@ -434,12 +449,102 @@ def healpy2alms(healpy_modes):
             Imag part is smaller as the m=0 modes shouldn't contain and 
             imaginary part. 
     """
-    lmax = hp.sphtfunc.Alm.getlmax(healpy_modes.size) # to remove the m=0 imag modes
-    alms = np.concatenate((healpy_modes.real,healpy_modes.imag[(lmax+1):]))
+    lmax = hp.sphtfunc.Alm.getlmax(healpy_modes.shape[-1]) # to remove the m=0 imag modes
+    alms = np.concatenate((healpy_modes.real,healpy_modes.imag[...,(lmax+1):]), axis=-1)
         
     return alms   
 
-def get_healpy_from_gsm(freq, lmax, nside=64, resolution="low", output_model=False, output_map=False):
+def map2alm_ducc(healpy_map, lmax, niter=3, nthreads=None):
+    """
+    Same as hp.map2alm() for a single (RING ordered) map, but using the 
+    ducc0 SHTs (https://gitlab.mpcdf.mpg.de/mtr/ducc) which are faster and
+    multithreaded. The same Jacobi iterations as in healpy are used, so the
+    alms agree with healpy to numerical precision.
+
+    Parameters
+    ----------
+    * healpy_map: (ndarray (floats))
+        The HEALpix map (RING ordering)
+
+    * lmax: (int)
+        Maximum l value for alms
+
+    * niter: (int) optional
+        Number of Jacobi iterations, default: 3 (as in healpy)
+
+    * nthreads: (int) optional
+        Number of threads, default: all cores available to the process
+
+    Returns
+    -------
+    * healpy_modes: (ndarray (complex))
+        Complex array of alms with same size and ordering as in healpy (m,l)
+    """
+    import ducc0
+
+    if nthreads is None:
+        nthreads = len(os.sched_getaffinity(0))
+
+    healpy_map = np.asarray(healpy_map, dtype=np.float64).reshape(1,-1)
+    nside = hp.npix2nside(healpy_map.shape[-1])
+    geometry = ducc0.healpix.Healpix_Base(nside, "RING").sht_info()
+    pixel_weight = 4*np.pi/healpy_map.shape[-1]
+
+    def synthesis(alm):
+        return ducc0.sht.experimental.synthesis(alm=alm, lmax=lmax, spin=0, nthreads=nthreads, **geometry)
+
+    def adjoint_synthesis(m):
+        return ducc0.sht.experimental.adjoint_synthesis(map=m, lmax=lmax, spin=0, nthreads=nthreads, **geometry)
+
+    healpy_modes = adjoint_synthesis(healpy_map*pixel_weight)
+    for _ in range(niter):
+        healpy_modes += adjoint_synthesis((healpy_map - synthesis(healpy_modes))*pixel_weight)
+
+    return healpy_modes[0]
+
+def rotate_alm_ducc(healpy_modes, lmax, coord, nthreads=None):
+    """
+    Same as hp.Rotator(coord=coord).rotate_alm(), but using ducc0. 
+
+    Parameters
+    ----------
+    * healpy_modes: (ndarray (complex))
+        Complex array of alms with same size and ordering as in healpy (m,l)
+
+    * lmax: (int)
+        Maximum l value for alms
+
+    * coord: (str)
+        The coordinate systems to rotate between, e.g. "GC" for galactic to 
+        equatorial, see hp.Rotator
+
+    * nthreads: (int) optional
+        Number of threads, default: all cores available to the process
+
+    Returns
+    -------
+    * healpy_modes_rot: (ndarray (complex))
+        The rotated alms
+    """
+    import ducc0
+
+    if nthreads is None:
+        nthreads = len(os.sched_getaffinity(0))
+
+    psi, theta, phi = hp.rotator.coordsys2euler_zyz(coord)
+
+    return ducc0.sht.rotate_alm(healpy_modes, lmax, psi, theta, phi, nthreads=nthreads)
+
+@functools.lru_cache(maxsize=None)
+def get_rotator(coord):
+    """
+    Returns the (cached) hp.Rotator for the coordinate transform coord, 
+    e.g. "GC" for galactic to equatorial, so the rotation matrix is only 
+    set up once.
+    """
+    return hp.Rotator(coord=coord)
+
+def get_healpy_from_gsm(freq, lmax, nside=64, resolution="low", output_model=False, output_map=False, cache_dir=None):
     """
     Generate an array of alms (HEALpy ordered) from gsm 2016 (https://github.com/telegraphic/pygdsm)
     
@@ -466,10 +571,18 @@ def get_healpy_from_gsm(freq, lmax, nside=64, resolution="low", output_model=Fal
         If output_map=True: Outputs map generated from the GSM data. 
         If output_map=False (default): no map output.
 
+    * cache_dir: (str) optional
+        Directory to cache the alms in, keyed by (freq, lmax, nside, resolution)
+        and whether freq is a scalar or an array,
+        so the SHT is skipped when they have already been computed. Only the alms
+        are cached, if output_model or output_map are set everything is recomputed.
+        If cache_dir=None (default): no caching.
+
     Returns
     -------
     *healpy_modes: (np.array)
-        Complex array of alms with same size and ordering as in healpy (m,l)
+        Complex array of alms with same size and ordering as in healpy (m,l).
+        Shape (Nfreqs, Nalms) if several frequencies are given.
     
     *gsm_2016: (PyGDSM 2016 model) optional
         If output_model=True: Outputs model generated from the GSM data. 
@@ -480,14 +593,37 @@ def get_healpy_from_gsm(freq, lmax, nside=64, resolution="low", output_model=Fal
         If output_map=False (default): no map output.
     
     """
+    use_cache = cache_dir is not None and output_model == False and output_map == False
+    if use_cache:
+        # ndim is part of the key as a scalar freq returns 1D alms, an array of freqs 2D
+        key = hashlib.sha1(repr((np.atleast_1d(freq).tolist(), np.ndim(freq), lmax, nside, resolution)).encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, f'gsm_{key}.npy')
+        if os.path.exists(cache_file):
+            return np.load(cache_file)
+
+    # All frequencies are generated in one call, one map per frequency
     gsm_2016 = GlobalSkyModel2016(freq_unit='MHz', resolution=resolution) 
     gsm_map = gsm_2016.generate(freqs=freq)
-    gsm_upgrade = hp.ud_grade(gsm_map, nside)
-    healpy_modes_gal = hp.map2alm(maps=gsm_upgrade,lmax=lmax)
+    gsm_upgrade = np.atleast_2d(hp.ud_grade(gsm_map, nside))
 
     # Per default it is in gal-coordinates, convert to equatorial
-    rot_gal2eq = hp.Rotator(coord="GC")
-    healpy_modes_eq = rot_gal2eq.rotate_alm(healpy_modes_gal)
+    if os.environ.get("CL_SAMPLER_USE_DUCC") == "1":
+        healpy_modes_eq = np.array([rotate_alm_ducc(map2alm_ducc(gsm_map_nu, lmax), lmax, coord="GC") 
+                                    for gsm_map_nu in gsm_upgrade])
+    else:
+        healpy_modes_gal = np.atleast_2d(hp.map2alm(maps=gsm_upgrade, lmax=lmax, pol=False))
+        rot_gal2eq = get_rotator(coord="GC")
+        healpy_modes_eq = np.array([rot_gal2eq.rotate_alm(healpy_modes_nu) for healpy_modes_nu in healpy_modes_gal])
+
+    if np.ndim(gsm_map) == 1:
+        healpy_modes_eq = healpy_modes_eq[0]
+
+    if use_cache:
+        # Write to a temporary file first, so other jobs never read a partial cache file
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, healpy_modes_eq)
+        os.replace(tmp_file, cache_file)
 
     if output_model == False and output_map == False: # default
         return healpy_modes_eq
@@ -498,7 +634,7 @@ def get_healpy_from_gsm(freq, lmax, nside=64, resolution="low", output_model=Fal
     else:
         return healpy_modes_eq, gsm_2016, gsm_map
 
-def get_alms_from_gsm(freq, lmax, nside=64, resolution='low', output_model=False, output_map=False):
+def get_alms_from_gsm(freq, lmax, nside=64, resolution='low', output_model=False, output_map=False, cache_dir=None):
     """
     Generate a real array split as [real, imag] (without the m=0 modes 
     imag-part) from gsm 2016 (https://github.com/telegraphic/pygdsm)
@@ -526,6 +662,10 @@ def get_alms_from_gsm(freq, lmax, nside=64, resolution='low', output_model=False
         If output_map=True: Outputs map generated from the GSM data. 
         If output_map=False (default): no map output.
 
+    * cache_dir: (str) optional
+        Directory to cache the alms in, see get_healpy_from_gsm().
+        If cache_dir=None (default): no caching.
+
     Returns
     -------
     * alms (ndarray (floats))
@@ -543,121 +683,339 @@ def get_alms_from_gsm(freq, lmax, nside=64, resolution='low', output_model=False
         If output_map=False (default): no map output.
     
     """
-    return healpy2alms(get_healpy_from_gsm(freq, lmax, nside, resolution, output_model, output_map))
+    return healpy2alms(get_healpy_from_gsm(freq, lmax, nside, resolution, output_model, output_map, cache_dir))
+
+def get_data_rhs_term(data, inv_noise_cov, vis_stack):
+    """
+    Computes the data term of the RHS of the GCR equation, V^T N^-1 d. 
+    This is the same for all samples, so it is only computed once.
+
+    Parameters
+    ----------
+    * data: (ndarray (complex))
+        The data vector (visibilities)
+
+    * inv_noise_cov: (ndarray (floats))
+        The diagonal of the inverse noise covariance
+
+    * vis_stack: (ndarray (floats))
+        The stacked visibility operator, see stack_vis_response()
 
-def construct_rhs_no_rot(data, inv_noise_cov, inv_signal_cov, omega_0, omega_1, a_0, vis_response):
+    Returns
+    -------
+    * data_term: (ndarray (floats))
+        The data term of the RHS, shape (Nalms)
+    """
+    # Stack the real and imag parts to match vis_stack, so the data term is a single GEMV
+    return vis_stack.T @ np.concatenate((inv_noise_cov*data.real, inv_noise_cov*data.imag))
+
+def construct_rhs_no_rot(data_term, inv_noise_cov, inv_signal_cov, omega_0, omega_1, a_0, vis_stack):
     
-    real_data_term = vis_response.real.T @ (inv_noise_cov*data.real + np.sqrt(inv_noise_cov)*omega_1.real)
-    imag_data_term = vis_response.imag.T @ (inv_noise_cov*data.imag + np.sqrt(inv_noise_cov)*omega_1.imag)
+    # Stack the real and imag parts to match vis_stack, so the fluctuation term is a single GEMV
+    sqrt_inv_noise_cov = np.sqrt(inv_noise_cov)
+    omega_1_stack = np.concatenate((sqrt_inv_noise_cov*omega_1.real, sqrt_inv_noise_cov*omega_1.imag))
+
+    fluctuation_term = vis_stack.T @ omega_1_stack
     prior_term = inv_signal_cov*a_0 + np.sqrt(inv_signal_cov)*omega_0
 
-    right_hand_side = real_data_term + imag_data_term + prior_term 
+    right_hand_side = data_term + fluctuation_term + prior_term 
     
     return right_hand_side
 
-def get_lhs_operators(vis_response, inv_noise_cov):
+def stack_vis_response(vis_response):
+    """
+    Stacks the real and imag parts of the visibility response operator into
+    one contiguous real array, so the real and imag terms of the GCR equation
+    are handled by a single BLAS call.
+
+    Parameters
+    ----------
+    * vis_response: (ndarray (complex))
+        Visibility operator, shape (Nvis, Nalms)
+
+    Returns
+    -------
+    * vis_stack: (ndarray (floats))
+        The real part stacked on top of the imag part, shape (2*Nvis, Nalms)
+    """
+    return np.concatenate((vis_response.real, vis_response.imag), axis=0)
+
+def get_lhs_operator(vis_stack, inv_noise_cov):
     """
-    Pre-computes the LHS operator
+    Pre-computes the data part of the LHS operator, i.e. the sum of the real
+    and imag parts, V_r^T N^-1 V_r + V_i^T N^-1 V_i.
+    The operator is scaled by N^-1/2 first, so the product is of the form 
+    W^T W, which numpy hands to the symmetric BLAS syrk (half the flops of gemm).
 
     """
-    real_op = vis_response.real.T @ ( inv_noise_cov[:,np.newaxis]* vis_response.real ) 
-    imag_op = vis_response.imag.T @ ( inv_noise_cov[:,np.newaxis]* vis_response.imag ) 
+    sqrt_inv_noise_stack = np.sqrt(np.concatenate((inv_noise_cov, inv_noise_cov)))
+    scaled_vis_stack = sqrt_inv_noise_stack[:,np.newaxis] * vis_stack
+    lhs_op = scaled_vis_stack.T @ scaled_vis_stack
 
-    return real_op, imag_op
+    return lhs_op
  
 
-def apply_lhs_no_rot(a_cr, real_op, imag_op, inv_signal_cov):
+class LHSOperator(LinearOperator):
     """
-    Applies the LHS operators to the alms, this function is to be used inside the sampler.
-    The real_op and imag_op are precomputed and parsed for computational efficiency.
+    LinearOperator for the LHS of the GCR equation, to be used inside the 
+    sampler. The lhs_op is precomputed and parsed for computational efficiency,
     the inv_signal_cov is updated for every sample.
+    Overrides _matvec directly, and sets the dtype up front, to avoid the 
+    generic LinearOperator(matvec=...) dispatch and dtype probing. The matvec
+    calls BLAS gemv directly and writes into preallocated buffers, so the 
+    returned vector is overwritten by the next matvec.
+
+    Parameters
+    ----------
+    * lhs_op: (ndarray (floats))
+        The precomputed data part of the LHS operator, see get_lhs_operator()
+
+    * inv_signal_cov: (ndarray (floats))
+        The diagonal of the inverse signal covariance
+    """
+    def __init__(self, lhs_op, inv_signal_cov):
+        super().__init__(dtype=lhs_op.dtype, shape=lhs_op.shape)
+        # lhs_op is symmetric, so its transpose is the same matrix in Fortran 
+        # order, which the BLAS wrapper takes without copying it in every call
+        self.lhs_op_f = lhs_op.T
+        self.inv_signal_cov = inv_signal_cov
+        self.gemv = get_blas_funcs('gemv', (lhs_op,))
+        # Output buffer of _matvec(), reused (and overwritten) by every call
+        self.out = np.empty(lhs_op.shape[0], dtype=lhs_op.dtype)
+
+    def _matvec(self, x):
+        x = x.ravel()
+        # y = S^-1 x, then y = lhs_op @ x + y in the same BLAS call (beta=1)
+        np.multiply(self.inv_signal_cov, x, out=self.out)
+        left_hand_side = self.gemv(1., self.lhs_op_f, x, beta=1., y=self.out, overwrite_y=True)
+
+        return left_hand_side
+
+    def _matmat(self, X):
+        # _matvec() returns the same out buffer in every call, so the default _matmat, 
+        # which stacks the matvecs, would give copies of the last column
+        return self.lhs_op_f.T @ X + self.inv_signal_cov[:,None] * X
+
+    def _adjoint(self):
+        # The operator is symmetric
+        return self
+
+def get_lhs_linear_op(lhs_op, inv_signal_cov):
     """
-    left_hand_side = real_op @ a_cr + imag_op @ a_cr + inv_signal_cov * a_cr 
+    Builds the LinearOperator for the LHS of the GCR equation. A new 
+    LinearOperator is needed whenever inv_signal_cov is updated.
 
-    return left_hand_side
+    Parameters
+    ----------
+    * lhs_op: (ndarray (floats))
+        The precomputed data part of the LHS operator, see get_lhs_operator()
 
-def lhs_operator(x):
+    * inv_signal_cov: (ndarray (floats))
+        The diagonal of the inverse signal covariance
+
+    Returns
+    -------
+    * lhs_linear_op: (LHSOperator)
+        The LHS operator to be parsed to the solver
     """
-    Wrapper function for matvec for LinearOperator since matvec only takes
-    one argument.
-    Make sure that the inverse noise covariance, inverse signal covariance,
-    and vis_response are correctly defined in the code before use.
+    return LHSOperator(lhs_op, inv_signal_cov)
 
+def pcg(A, b, x0=None, tol=1e-05, maxiter=None, inv_diag=None):
     """
+    Conjugate gradient solver with a Jacobi (diagonal) preconditioner. 
+    Follows the conventions of scipy.sparse.linalg.cg, i.e. the solver 
+    stops when ||r|| < tol*||b||. The p, z and work vectors are allocated
+    once and updated in-place in every iteration.
+
+    Parameters
+    ----------
+    * A: (LinearOperator)
+        The (symmetric positive definite) LHS operator
+
+    * b: (ndarray (floats))
+        The RHS vector
+
+    * x0: (ndarray (floats)) optional
+        Initial guess for the solution, not modified. Default: zeros.
+
+    * tol: (float) optional
+        Relative tolerance for convergence. Default: 1e-05 (as in scipy)
+
+    * maxiter: (int) optional
+        Maximum number of iterations. Default: 10*b.size (as in scipy)
 
-    return apply_lhs_no_rot(x, real_op, imag_op, inv_signal_cov)
+    * inv_diag: (ndarray (floats)) optional
+        The inverse of the diagonal of A used as the preconditioner.
+        Default: no preconditioning.
+
+    Returns
+    -------
+    * x: (ndarray (floats))
+        The solution
+
+    * info: (int)
+        0 if the solver converged, otherwise the number of iterations.
+    """
+    if maxiter is None:
+        maxiter = 10*b.size
+
+    if inv_diag is None:
+        inv_diag = np.ones_like(b)
+
+    if x0 is None:
+        x = np.zeros_like(b)
+        r = b.copy()
+    else:
+        x = np.array(x0, dtype=b.dtype, copy=True)
+        r = b - A.matvec(x)
+
+    atol = tol * np.linalg.norm(b)
+    if atol == 0.:
+        return b.copy(), 0
+
+    z = inv_diag * r
+    p = z.copy()
+    work = np.empty_like(b)
+    rz = np.dot(r, z)
+
+    for iteration in range(maxiter):
+        if np.linalg.norm(r) < atol:
+            return x, 0
+
+        Ap = A.matvec(p)
+        alpha = rz / np.dot(p, Ap)
+
+        np.multiply(p, alpha, out=work)
+        x += work
+        np.multiply(Ap, alpha, out=work)
+        r -= work
+
+        np.multiply(inv_diag, r, out=z)
+        rz_new = np.dot(r, z)
+        beta = rz_new / rz
+        rz = rz_new
+
+        p *= beta
+        p += z
+
+    if np.linalg.norm(r) < atol:
+        return x, 0
+
+    return x, maxiter
 
 def radiometer_eq(auto_visibilities, ants, delta_time, delta_freq, Nnights = 1, include_autos=False):
-    nbls = len(ants)
-    indx = auto_visibilities.shape[0]//nbls
-    
-    sigma_full = np.empty((0))#, autos.shape[-1]))
-
-    for i in ants:
-        vis_ii = auto_visibilities[i*indx:(i+1)*indx]#,:]
-
-        for j in ants:
-            if include_autos == True:
-                if j >= i:
-                    vis_jj = auto_visibilities[j*indx:(j+1)*indx]#,:]
-                    sigma_ij = ( vis_ii*vis_jj ) / ( Nnights*delta_time*delta_freq )
-                    sigma_full = np.concatenate((sigma_full,sigma_ij))
-            else:
-                if j > i:  # only keep this line if you don't want the auto baseline sigmas
-                    vis_jj = auto_visibilities[j*indx:(j+1)*indx]#,:]
-                    sigma_ij = ( vis_ii*vis_jj ) / ( Nnights*delta_time*delta_freq )
-                    sigma_full = np.concatenate((sigma_full,sigma_ij))
+    nants = len(ants)
+    indx = auto_visibilities.shape[0]//nants
+
+    # One row of auto visibilities per antenna
+    vis_autos = auto_visibilities.reshape(nants, indx)
+
+    # Baselines ordered as (i, j>i), or (i, j>=i) if the autos are included
+    ant_i, ant_j = np.triu_indices(nants, k=(0 if include_autos else 1))
+    sigma_full = ( vis_autos[ant_i]*vis_autos[ant_j] ) / ( Nnights*delta_time*delta_freq )
  
     # this will be complex type due to inputs, check that the imag part is zero and recast type
     assert np.all(sigma_full.imag == 0), "The imag part of the radiometer eq is not zero"                   
     
-    return sigma_full.real
+    return sigma_full.real.ravel()
 
-def get_alm_samples(data_vec,
+def solve_lhs_cg(lhs_op, lhs_op_diag, inv_signal_cov, rhs, initial_guess, tolerance, maxiter, lhs_op_fp32=None):
+    """
+    Solves the GCR equation with the Jacobi preconditioned CG solver, pcg().
+    The lhs_op_diag is the precomputed diagonal of lhs_op, only the signal 
+    part of the preconditioner is updated per sample.
+    If lhs_op_fp32 (a float32 copy of lhs_op) is given, the bulk of the 
+    iterations are done in single precision and the solution is then refined 
+    in double precision up to the requested tolerance.
+
+    Returns
+    -------
+    * x_soln: (ndarray (floats))
+        The solution
+
+    * convergence_info: (int)
+        0 if the solver converged, otherwise the number of iterations.
+    """
+    # Construct LHS operator and its Jacobi preconditioner
+    lhs_linear_op = get_lhs_linear_op(lhs_op, inv_signal_cov)
+    lhs_diag = lhs_op_diag + inv_signal_cov
+
+    if lhs_op_fp32 is not None:
+        # float32 can't reach tolerances much below its machine precision
+        tol_fp32 = max(tolerance, 100*np.finfo(np.float32).eps)
+        initial_guess, _ = pcg(A = get_lhs_linear_op(lhs_op_fp32, inv_signal_cov.astype(np.float32)),
+                               b = rhs.astype(np.float32),
+                               tol = tol_fp32,
+                               maxiter = maxiter,
+                               x0 = initial_guess,
+                               inv_diag = (1/lhs_diag).astype(np.float32))
+
+    x_soln, convergence_info = pcg(A = lhs_linear_op,
+                                   b = rhs,
+                                   tol = tolerance,
+                                   maxiter = maxiter,
+                                   x0 = initial_guess,
+                                   inv_diag = 1/lhs_diag) 
+
+    return x_soln, convergence_info
+
+def get_alm_samples(data_term,
                     inv_noise_cov,
                     inv_signal_cov,
                     a_0,
-                    vis_response,
-                    real_op,
-                    imag_op,
+                    vis_stack,
+                    lhs_op,
+                    lhs_op_diag,
                     initial_guess,
                     random_seed,
                     tolerance,
-                    savefile):
+                    maxiter,
+                    savefile,
+                    lhs_op_fp32=None,
+                    dense_max_size=4096):
     """
-    Function to draw samples from the GCR equation.
+    Function to draw samples from the GCR equation. If the number of modes
+    is at most dense_max_size, the system is solved directly with a dense 
+    Cholesky factorisation, which is cheaper than the CG iterations for 
+    modest lmax. Otherwise solve_lhs_cg() is used, see there for 
+    lhs_op_diag and lhs_op_fp32.
     """
     t_iter = time.time()
 
-    np.random.seed(random_seed)
-    #random_seed = np.random.get_state()[1][0] #for test/output purposes
+    rng = np.random.default_rng(random_seed)
     
     # Generate random maps for the realisations
-    omega_0 = np.random.randn(a_0.size)
-    omega_1 = (np.random.randn(data_vec.size) + 1.j*np.random.randn(data_vec.size))/np.sqrt(2)
+    omega_0 = rng.standard_normal(a_0.size)
+    omega_1 = (rng.standard_normal(inv_noise_cov.size) + 1.j*rng.standard_normal(inv_noise_cov.size))/np.sqrt(2)
     
     # Construct RHS
-    rhs = construct_rhs_no_rot(data_vec,
+    rhs = construct_rhs_no_rot(data_term,
                                inv_noise_cov, 
                                inv_signal_cov,
                                omega_0,
                                omega_1,
                                a_0,
-                               vis_response)
+                               vis_stack)
 
-    # Construct LHS operator
-    lhs_shape = (rhs.size, rhs.size)
-    lhs_linear_op = LinearOperator(matvec = lhs_operator,
-                                   shape = lhs_shape)
-    
-    
     # Run and time solver
     time_start_solver = time.time()
-    x_soln, convergence_info = solver(A = lhs_linear_op,
-                                      b = rhs,
-                                      tol = tolerance,
-                                      maxiter = maxiter,
-                                      x0 = initial_guess) 
+    if rhs.size <= dense_max_size:
+        # Add the signal part to the diagonal of a copy of lhs_op and solve directly
+        lhs_dense = lhs_op.copy()
+        lhs_dense.flat[::rhs.size+1] += inv_signal_cov
+        lhs_cho = cho_factor(lhs_dense, overwrite_a=True, check_finite=False)
+        x_soln = cho_solve(lhs_cho, rhs, check_finite=False)
+        convergence_info = 0
+
+    else:
+        x_soln, convergence_info = solve_lhs_cg(lhs_op = lhs_op,
+                                                lhs_op_diag = lhs_op_diag,
+                                                inv_signal_cov = inv_signal_cov,
+                                                rhs = rhs,
+                                                initial_guess = initial_guess,
+                                                tolerance = tolerance,
+                                                maxiter = maxiter,
+                                                lhs_op_fp32 = lhs_op_fp32)
 
     solver_time = time.time() - time_start_solver
     iteration_time = time.time()-t_iter
@@ -677,11 +1035,14 @@ def get_alm_samples(data_vec,
     _ = savefile.create_dataset(name="x_soln", data=x_soln)
     _ = savefile.create_dataset(name="omega_0", data=omega_0)
     _ = savefile.create_dataset(name="omega_1", data=omega_1)
-    _ = savefile.create_dataset(name="alm_random_seed", data=random_seed)
     _ = savefile.create_dataset(name="rhs", data=rhs)
-    _ = savefile.create_dataset(name="convergence_info", data=convergence_info)
-    _ = savefile.create_dataset(name="solver_time", data=solver_time)
-    _ = savefile.create_dataset(name="iteration_time", data=iteration_time)
+
+    # Scalars are stored as attributes of the sample group, which avoids the 
+    # metadata overhead of a separate dataset for each of them
+    savefile.attrs.update({"alm_random_seed": random_seed,
+                           "convergence_info": convergence_info,
+                           "solver_time": solver_time,
+                           "iteration_time": iteration_time})
         
     return x_soln, iteration_time
 
@@ -709,24 +1070,52 @@ def get_sigma_ell(alms,lmax):
         An array of sigma_ell values for the angular power spectrum.
     """
 
-    # excluding ell=0 because it's not defined for the invgamma func.
-    sigma_ell = np.zeros(shape = ((lmax+1)-1))
+    ems_idx, ells_idx, _ = get_em_ell_idx(lmax)
 
-    # Calculate sigma_ell = 1/(2*ell + 1) sum_m |a_lm|^2
-    for ell in np.arange(1,lmax+1):
-        real_idx, _ = get_idx_ml(0,ell,lmax)
-        sigma_ell[ell-1] = alms[real_idx] * alms[real_idx]
+    # The m=0 modes (real only) count once, all others twice due to the +-m symmetry
+    weights = np.where(ems_idx == 0, 1., 2.)
 
-        for em in np.arange(1,ell+1):
-            real_idx, imag_idx = get_idx_ml(em, ell, lmax)
-            sigma_ell[ell-1] += 2 * (alms[real_idx] * alms[real_idx] +
-                                     alms[imag_idx] * alms[imag_idx])
-        
-        sigma_ell[ell-1] /= 2*ell + 1
+    # Calculate sigma_ell = 1/(2*ell + 1) sum_m |a_lm|^2 for all ell at once
+    sigma_ell = np.bincount(ells_idx, weights=weights*alms*alms, minlength=lmax+1)
+
+    # excluding ell=0 because it's not defined for the invgamma func.
+    unique_ell = np.arange(1,lmax+1)
+    sigma_ell = sigma_ell[1:] / (2*unique_ell + 1)
 
     return sigma_ell
 
-def get_cl_samples(alms, lmax, random_seed, key, savefile):
+def get_invgamma_draws(lmax, random_seed, n_draws=None):
+    """
+    Draws from the inverse gamma distributions with shape a = (2*ell - 1)/2 
+    and unit scale for ell = 1,...,lmax, which are rescaled by sigma_ell 
+    to get the C_ell samples in get_cl_samples().
+
+    Parameters
+    ----------
+    * lmax: (int)
+        The lmax of the modes.
+
+    * random_seed: (int)
+        Sets the random seed for the draws
+
+    * n_draws: (int) optional
+        Number of sets of draws, e.g. one per sample of a chain, which are 
+        all drawn in one call. Default: None, a single set.
+
+    Returns
+    -------
+    * invgamma_draws: (ndarray (floats))
+        Array of shape (lmax) or (n_draws, lmax), ordered by ell-value.
+    """
+    rng = np.random.default_rng(random_seed)
+
+    unique_ell = np.arange(1,lmax+1)
+    a = (2*unique_ell - 1)/2
+    size = lmax if n_draws is None else (n_draws, lmax)
+
+    return invgamma.rvs(a, loc=0, scale=1, size=size, random_state=rng)
+
+def get_cl_samples(alms, lmax, random_seed, key, savefile, invgamma_draws=None, invgamma_row=None):
     """
     Uses the inverse gamma function (see Eriksen 2007) to generate 
     samples of C_ell given the alms. The inverse gammafunction doesn't
@@ -743,7 +1132,9 @@ def get_cl_samples(alms, lmax, random_seed, key, savefile):
         The lmax of the modes.
 
     * random_seed: (int)
-        Sets the random seed for the specific function call
+        Sets the random seed for the specific function call. If invgamma_draws
+        are given, it is the seed they were drawn with in get_invgamma_draws()
+        and is only saved.
 
     * key: (int)
         The label for the specific sample number for the file name
@@ -752,6 +1143,15 @@ def get_cl_samples(alms, lmax, random_seed, key, savefile):
         The group for the specific sample number to save all Cl-samples and 
         additional information to.
 
+    * invgamma_draws: (ndarray (floats)) optional
+        Pre-drawn samples from get_invgamma_draws() for this sample. 
+        Default: None, they are drawn here using random_seed.
+
+    * invgamma_row: (int) optional
+        The row of get_invgamma_draws(lmax, random_seed, n_draws) that
+        invgamma_draws is, saved alongside the seed so the sample can be
+        reproduced. Default: None, the draws are from random_seed alone.
+
     Returns
     -------
     * cl_samples: (ndarray (floats))
@@ -759,15 +1159,14 @@ def get_cl_samples(alms, lmax, random_seed, key, savefile):
         Note, the inverse gamma function doesn't work for ell=0, so this mode is
         excluded.
     """
-    np.random.seed(random_seed)
+    if invgamma_draws is None:
+        invgamma_draws = get_invgamma_draws(lmax, random_seed)
     
     sigma_ell = get_sigma_ell(alms, lmax)
 
     unique_ell = np.arange(1,lmax+1)
-    a = (2*unique_ell - 1)/2
     
-    cl_samples = invgamma.rvs(a, loc=0, scale=1)
-    cl_samples *= sigma_ell * (2*unique_ell +1)/2
+    cl_samples = invgamma_draws * sigma_ell * (2*unique_ell +1)/2
 
     ## Save output
     #np.savez(path+'cls_'+f'{data_seed}_'+f'{random_seed}_'+f'{key}',
@@ -778,8 +1177,12 @@ def get_cl_samples(alms, lmax, random_seed, key, savefile):
  
     _ = savefile.create_dataset(name="cl_sample", data=cl_samples)
     _ = savefile.create_dataset(name="sigma_ell", data=sigma_ell)
-    _ = savefile.create_dataset(name="cl_random_seed", data=random_seed)
-    _ = savefile.create_dataset(name="key", data=key)
+
+    # Scalars as attributes, see get_alm_samples()
+    savefile.attrs.update({"cl_random_seed": random_seed,
+                           "key": key})
+    if invgamma_row is not None:
+        savefile.attrs["invgamma_row"] = invgamma_row
 
     return cl_samples
 
@@ -820,18 +1223,13 @@ def set_signal_cov_by_cl(prior_cov, cl_samples, lmax):
     signal_cov = prior_cov.copy()
 
     # Then update all other entries (ell > 0)
-    for ell in np.arange(1,lmax+1):
-        real_idx, _ = get_idx_ml(0,ell,lmax)
-        signal_cov[real_idx] = 0.5 * cl_samples[ell-1]  # factor 1/2 due to 'realification'
-
-        for em in np.arange(1,ell+1):
-            real_idx, imag_idx = get_idx_ml(em, ell, lmax)
-            signal_cov[real_idx] = 0.5 * cl_samples[ell-1]  # factor 1/2 due to 'realification'
-            signal_cov[imag_idx] = 0.5 * cl_samples[ell-1]  # factor 1/2 due to 'realification'
+    _, ells_idx, _ = get_em_ell_idx(lmax)
+    mask = ells_idx >= 1
+    signal_cov[mask] = 0.5 * cl_samples[ells_idx[mask]-1]  # factor 1/2 due to 'realification'
 
     return signal_cov
 
-def diagonalise_cl_model(params, freq_list, nu_ref):
+def diagonalise_cl_model(params, freq_list, nu_ref, eigenvalue_tol=1e-08):
     """
     Based on Cl(nu1,nu2) model from Santos et al 2005. Here it is used for the RSB excess component. 
     Note that this model is not defined for ell=0, see get_monopole() for this mode. 
@@ -850,65 +1248,52 @@ def diagonalise_cl_model(params, freq_list, nu_ref):
     * nu_ref (float)
         The reference frequency in Hz
 
+    * eigenvalue_tol (float)
+        Eigenvalues below this value are treated as zero and are not computed.
+        Default is 1e-08.
+
     
     Returns
     -------
-    * eigenvalues (ndarray (complex128))
-        All the eigenvalues of the cl-model
+    * eigenvalues (ndarray (floats))
+        The non-zero eigenvalues of the cl-model in descending order
 
-    * eigenvectors (ndarray (complex128))
-        All the eigenvectors of the cl-model
+    * eigenvectors (ndarray (floats))
+        The corresponding eigenvectors of the cl-model, stored as columns in the
+        same order as the eigenvalues
 
     """
 
     beta = params[2]
     xi = params[3]
 
-    nfreqs = len(freq_list)
-
-    diag_cl_model = np.zeros(shape=(nfreqs,nfreqs))
-
-    for i, nu1 in enumerate(freq_list):
-        for j, nu2 in enumerate(freq_list):
-            diag_cl_model[i,j] = ((nu1*nu2)/(nu_ref**2))**beta * np.exp((-np.log(nu1/nu2)**2)/(2*xi**2))
-
-    # Diagonalise the Cl-model
-    eigenvalues, eigenvectors = np.linalg.eig(diag_cl_model)
-    eig_idx = np.argsort(eigenvalues)[::-1]
-    eigenvalues = eigenvalues[eig_idx]
-    eigenectors = eigenvectors[eig_idx]
+    # ((nu1*nu2)/nu_ref^2)^beta = (nu1/nu_ref)^beta * (nu2/nu_ref)^beta, so the power
+    # is only taken once per frequency and log(nu1/nu2) = log(nu1) - log(nu2)
+    # The matrix is built in place in a single nfreqs x nfreqs buffer
+    nu = np.asarray(freq_list, dtype=np.float64)
+    power_law = (nu/nu_ref)**beta
+    log_nu = np.log(nu)
+
+    diag_cl_model = np.subtract.outer(log_nu, log_nu)
+    np.square(diag_cl_model, out=diag_cl_model)
+    diag_cl_model *= -1/(2*xi**2)
+    np.exp(diag_cl_model, out=diag_cl_model)
+    diag_cl_model *= power_law[:,None]
+    diag_cl_model *= power_law[None,:]
+
+    # Diagonalise the (real, symmetric) Cl-model. Only the eigenpairs above the
+    # tolerance are computed, and eigh returns them in ascending order with the
+    # eigenvectors as columns
+    eigenvalues, eigenvectors = eigh(diag_cl_model,
+                                     subset_by_value=(eigenvalue_tol, np.inf),
+                                     overwrite_a=True,
+                                     check_finite=False)
+    eigenvalues = eigenvalues[::-1]
+    eigenvectors = eigenvectors[:, ::-1]
 
     return eigenvalues, eigenvectors
 
-def extract_nonzero_eigenvalues(eigenvalues):
-    """
-    Function to assert that the imaginary part of the eigenvalues is zero and only
-    return the non-zero real parts along with their list indices.
-
-    Parameters
-    ----------
-    * eigenvalues (ndarray (complex128))
-        Array of the eigenvalues of the cl-model
-
-    Returns
-    -------
-    * eigenvalues_real (ndarray (floats))
-        The non-zero real-parts of the eigenvalues
-
-    * eigenvalues_idx (ndarray (int))
-        List of the indices of the non-zero eigenvalues
-    """
-
-    assert np.all(np.isclose(eigenvalues.imag, 0)), \
-            'there are non-zero imaginary parts in the eigenvalues of the Cls'
-
-    eigenvalues_idx = np.where(~np.isclose(eigenvalues.real,0))[0]
-    eigenvalues_real = eigenvalues.real[eigenvalues_idx]
-
-    return eigenvalues_real, eigenvalues_idx
-
-
-def get_alms_fiducial(params, freq_list, nu_ref, lmax, ell_ref):
+def get_alms_fiducial(params, freq_list, nu_ref, lmax, ell_ref, out_alm=None):
     """
     Uses hp.synalm to generate alms from the Cls calculated as 
     the n'th Cl component given a specific eigenmode. See Alonso et al 2014
@@ -932,6 +1317,10 @@ def get_alms_fiducial(params, freq_list, nu_ref, lmax, ell_ref):
     * ell_ref (integer)
         The reference value that the Cl-model is defined for.
 
+    * out_alm (ndarray (complex128)), optional
+        Preallocated (nfreqs, nalm) array that the alms are written into,
+        e.g. when the model is drawn repeatedly. If None, a new array is returned.
+
     Returns
     -------
     * alms_fiducial (ndarray (floats)
@@ -946,23 +1335,21 @@ def get_alms_fiducial(params, freq_list, nu_ref, lmax, ell_ref):
     eigenvalues, eigenvectors = diagonalise_cl_model(params=params,
                                                      freq_list=freq_list,
                                                      nu_ref=nu_ref)
- 
-    nonzero_eigenvalues, eigenvalues_idx = extract_nonzero_eigenvalues(eigenvalues=eigenvalues)
 
-    Cl_n = np.zeros(shape=(eigenvalues_idx.size, lmax+1))
-    alm_n = np.zeros(shape=(eigenvalues_idx.size, (lmax+1)*((lmax+1)+1)//2),
-                            dtype=np.complex128)
+    ell_factor = np.empty(lmax+1)
+    ell_factor[0] = 0 # Set the monopole to zero for now
+    ell_factor[1:] = A*(np.arange(1,lmax+1)/ell_ref)**alpha
 
-    for n, eigenvalue_n in enumerate(nonzero_eigenvalues):
-        Cl_n[n,0] = 0 # Set the monopole to zero for now 
+    Cl_n = eigenvalues[:,None] * ell_factor[None,:]
 
-        for ell in np.arange(1,lmax+1):
-            Cl_n[n,ell] = A*(ell/ell_ref)**alpha * eigenvalue_n
-        
-        alm_n[n,:] = hp.synalm(Cl_n[n,:])
+    # The eigenmodes are uncorrelated, so all of them are drawn in one call with
+    # the cross-spectra set to None. The random draws are taken in the same order
+    # as calling hp.synalm once per mode.
+    n_modes = eigenvalues.size
+    alm_n = hp.synalm(list(Cl_n) + [None]*(n_modes*(n_modes-1)//2), lmax=lmax, new=True)
 
-    eigenmodes = eigenvectors[:, eigenvalues_idx].T
-    alms_fiducial = np.sum(alm_n[:,None,:]*eigenmodes[:,:,None], axis=0)
+    # (nfreqs x K) @ (K x nalm), without forming the (K, nfreqs, nalm) product
+    alms_fiducial = np.matmul(eigenvectors, alm_n, out=out_alm)
 
     return alms_fiducial
 
@@ -998,7 +1385,7 @@ def get_monopole(monopole_params, freq_list, nu_ref):
 
     return monopole
 
-def RSB_data_model(freq_list, lmax):
+def RSB_data_model(freq_list, lmax, freq_idx=None):
     """
     Generates a set of alms for the RSB model given in Zhang et al 2024 and with
     a monopole term defined by Dowell and Taylor 2018. The alms are generated to
@@ -1015,6 +1402,10 @@ def RSB_data_model(freq_list, lmax):
     * lmax (integer)
         The maximum ell-value for the spherical harmonics 
 
+    * freq_idx (integer)
+        Index into freq_list of the only frequency to return the alms for.
+        If None, the alms for all the frequencies are returned.
+
     Returns:
     --------
     * RSB_alms (ndarray (floats))
@@ -1045,10 +1436,186 @@ def RSB_data_model(freq_list, lmax):
 
     RSB_hp[:,0] = get_monopole(monopole_params, freq_list, nu_ref)
 
-    RSB_alms = np.array([healpy2alms(RSB_mode) for RSB_mode in RSB_hp]) 
+    if freq_idx is not None:
+        RSB_hp = RSB_hp[freq_idx]
+
+    # healpy2alms packs all the frequencies at once along the last axis
+    RSB_alms = healpy2alms(RSB_hp)
 
     return RSB_alms
 
+def run_chain(chain_id,
+              chain_label,
+              n_samples,
+              data_term,
+              inv_noise_cov,
+              prior_cov,
+              a_0,
+              vis_stack,
+              lhs_op,
+              lhs_op_diag,
+              lhs_op_fp32,
+              dense_max_size,
+              initial_guess,
+              lmax,
+              tolerance,
+              maxiter,
+              path,
+              jobid=0,
+              save_step=100):
+    """
+    Runs one Gibbs chain, alternating between drawing alm samples given the 
+    signal covariance and C_ell samples given the alms. The first alm sample
+    uses the prior covariance. All the state is parsed explicitly, so 
+    independent chains can be run in parallel processes.
+    The samples are saved in hdf5 files in path, save_step samples per file.
+
+    Parameters
+    ----------
+    * chain_id: (int)
+        Index of the chain within the job, the random seeds for the alm draws 
+        are derived from a SeedSequence of (jobid, chain_id, sample_no), the 
+        C_ell draws of the chain come from one stream derived from (jobid, chain_id)
+
+    * chain_label: (str)
+        Prefix for the sample files to tell the chains apart
+
+    * n_samples: (int)
+        Number of samples in the chain
+
+    * data_term: (ndarray (floats))
+        The precomputed data term of the RHS, see get_data_rhs_term()
+
+    * prior_cov: (ndarray (floats))
+        The diagonal of the prior covariance, used for the first sample
+        and for the ell=0 modes, see set_signal_cov_by_cl()
+
+    * lhs_op_diag: (ndarray (floats))
+        The diagonal of lhs_op, for the Jacobi preconditioner
+
+    * lhs_op_fp32: (ndarray (float32) or None)
+        float32 copy of lhs_op for the mixed precision solver, 
+        None to solve in float64 only
+
+    * dense_max_size: (int)
+        Largest number of modes solved with the dense Cholesky solver, 
+        see get_alm_samples()
+
+    * initial_guess: (ndarray (floats))
+        The initial guess for the solver for the first sample
+
+    * jobid: (int) optional
+        The array job id, so different jobs draw different chains 
+        independently of their number of chains. Default: 0
+
+    * save_step: (int) optional
+        Number of samples saved per hdf5 file. Default: 100
+
+    The remaining parameters are parsed to get_alm_samples()
+
+    Returns
+    -------
+    * avg_iter_time: (float)
+        The average time per sample (alm and C_ell) in sec.
+    """
+    inv_signal_cov = 1/prior_cov
+    avg_iter_time = 0
+    savefile = None
+    status = -1
+
+    # The inverse gamma draws for all the C_ell samples of the chain are done at once, 
+    # from a separate random stream (spawn_key) than the per-sample alm seeds.
+    # The seed is per chain, each sample saves its row of the draws as invgamma_row
+    cl_random_seed = np.random.SeedSequence([jobid, chain_id], spawn_key=(0,)).generate_state(1)[0]
+    invgamma_draws = get_invgamma_draws(lmax, cl_random_seed, n_draws=n_samples)
+    
+    for sample_no in range(n_samples):
+
+        sample_start_time = time.time()
+
+        # Set up hdf5 data file
+        if sample_no // save_step > status:
+            if savefile is not None:
+                savefile.close()
+            savefile = h5py.File(path+f"samples_{chain_label}{sample_no:05d}_to_{sample_no+save_step-1:05d}.hdf5", "a")
+            status = sample_no // save_step
+
+        samplegroup = savefile.create_group(f"sample_{sample_no:05d}")
+
+        # Random seed for the alm draws, set by the job, chain and sample no.
+        alm_random_seed = np.random.SeedSequence([jobid, chain_id, sample_no]).generate_state(1)[0]
+
+        # get alm samples using prior for the first sample, then C_ell 
+        x_soln, iteration_time = get_alm_samples(data_term = data_term,
+                                                 inv_noise_cov = inv_noise_cov,
+                                                 inv_signal_cov = inv_signal_cov,
+                                                 a_0 = a_0,
+                                                 initial_guess = initial_guess,
+                                                 vis_stack = vis_stack,
+                                                 lhs_op = lhs_op,
+                                                 lhs_op_diag = lhs_op_diag,
+                                                 random_seed = alm_random_seed,
+                                                 tolerance = tolerance,
+                                                 maxiter = maxiter,
+                                                 savefile = samplegroup,
+                                                 lhs_op_fp32 = lhs_op_fp32,
+                                                 dense_max_size = dense_max_size)
+        # pcg() copies x0, so the previous solution can be passed on as is
+        initial_guess = x_soln
+
+        # get cl samples
+        cl_samples = get_cl_samples(alms = x_soln,
+                                    lmax = lmax,
+                                    random_seed = cl_random_seed,
+                                    key = sample_no,
+                                    savefile = samplegroup,
+                                    invgamma_draws = invgamma_draws[sample_no],
+                                    invgamma_row = sample_no)
+        
+
+        # Change signal_cov to use C_ell values
+        signal_cov = set_signal_cov_by_cl(prior_cov = prior_cov,
+                                          cl_samples = cl_samples,
+                                          lmax = lmax)
+        inv_signal_cov = 1/signal_cov
+            
+        sample_total_time = time.time() - sample_start_time
+        avg_iter_time += sample_total_time
+
+    if savefile is not None:
+        savefile.close()
+
+    return avg_iter_time / n_samples
+
+# The shared arguments of run_chain() in each worker process, see init_chain_worker()
+_chain_worker_kwargs = {}
+
+def init_chain_worker(run_chain_kwargs, blas_threads=None):
+    """
+    Pool initializer which stores the arguments shared by all chains 
+    (the large precomputed operators) once per worker process. With the 
+    default fork start method on Linux they are inherited from the parent
+    without pickling, so only the chain ids are sent per task.
+    If blas_threads is given, the BLAS threads of the worker are limited to
+    blas_threads so the chains don't oversubscribe the cores. This requires
+    threadpoolctl (optional), without it the BLAS defaults are kept.
+    """
+    global _chain_worker_kwargs
+    _chain_worker_kwargs = run_chain_kwargs
+
+    if blas_threads is not None:
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            return
+        threadpool_limits(limits=blas_threads, user_api='blas')
+
+def run_chain_worker(chain_id, chain_label):
+    """
+    Runs run_chain() in a worker process set up by init_chain_worker().
+    """
+    return run_chain(chain_id, chain_label, **_chain_worker_kwargs)
+
 ###### MAIN ######    
 if __name__ == "__main__":
     start_time = time.time()
@@ -1065,6 +1632,13 @@ if __name__ == "__main__":
         print(f'Created folder {path}\n')
     except FileExistsError:
         print(f'Folder {path} already exists\n')
+
+    # Directory for caching precomputed quantities between runs
+    if ARGS['cache_dir']:
+        cache_dir = str(ARGS['cache_dir'])
+        os.makedirs(cache_dir, exist_ok=True)
+    else:
+        cache_dir = None
     
     # Defining the data_seed for the noise of the simulated data
     if ARGS['data_seed']:
@@ -1112,6 +1686,26 @@ if __name__ == "__main__":
         # Defaults to 30000, but rememeber to check convergence_info!
         maxiter = 30000
 
+    # Precision of the bulk of the solver iterations for the alm-samples
+    if ARGS['precision']:
+        if ARGS['precision'].lower() in ('fp32', 'fp64'):
+            precision = ARGS['precision'].lower()
+        else:
+            raise argparse.ArgumentTypeError('fp32 or fp64 expected')
+    else:
+        precision = 'fp64'
+
+    # Largest number of modes for the direct solver, CG is used above this.
+    # If the cg-solver is configured (precision, tol or maxiter) it is used by default
+    cg_options_set = (precision == 'fp32' or ARGS['tolerance'] is not None
+                      or ARGS['maxiter'] is not None)
+    if ARGS['dense_max_size'] is not None:
+        dense_max_size = int(ARGS['dense_max_size'])
+    elif cg_options_set:
+        dense_max_size = 0
+    else:
+        dense_max_size = 4096
+
     # Including RSB excess signal in the data model:
     if ARGS['include_RSB']:
         if ARGS['include_RSB'].lower() in ('true', 'yes', 't', 'y', '1'):
@@ -1148,12 +1742,23 @@ if __name__ == "__main__":
         # If none is passed use 100 samples as default
         n_samples = 100
 
+    # Number of independent chains
+    if ARGS['number_of_chains']:
+        n_chains = int(ARGS['number_of_chains'])
+    else:
+        n_chains = 1
+
     # The lmax for the spherical harmonic modes
     if ARGS['lmax']:
         lmax = int(ARGS['lmax'])
     else:
         lmax = 20
 
+    if cg_options_set and (lmax+1)**2 <= dense_max_size:
+        print(f'Warning: the {(lmax+1)**2} alm modes are solved with the dense solver '
+              f'(dense_max_size={dense_max_size}), so precision, tol and maxiter are ignored '
+              f'for the alm-samples. Set -dense_max=0 to use the cg-solver.\n')
+
     # The nside / resolution for HEALpy operations
     if ARGS['nside']:
         nside = int(ARGS['nside'])
@@ -1224,20 +1829,23 @@ if __name__ == "__main__":
     delta_time = 60 # s
     delta_freq = 1e+06 # (M)Hz
     latitude = 30.7215 * np.pi / 180  # HERA loc in decimal numbers ## There's some sign error in the code, so this missing sign is a quick fix
-    solver = cg
 
     # Precompute the visibility reponse operator
-    vis_response, autos, ell, m = vis_proj_operator_no_rot(freqs=freqs, 
-                                                        lsts=lsts, 
-                                                        beams=beams, 
-                                                        ant_pos=ant_pos, 
-                                                        lmax=lmax, 
-                                                        nside=nside,
-                                                        latitude=latitude)
-
-    # Setting the random seed to the prior_seed and calculating true sky
+    vis_response, autos, ell, m = get_vis_proj_operator_cached(freqs=freqs, 
+                                                               lsts=lsts, 
+                                                               beams=beams, 
+                                                               ant_pos=ant_pos, 
+                                                               lmax=lmax, 
+                                                               nside=nside,
+                                                               latitude=latitude,
+                                                               dish_diameter=dish_diameter,
+                                                               cache_dir=cache_dir)
+
+    # Setting the random seed to the prior_seed and calculating true sky.
+    # The global seed is only kept for hp.synalm() in the RSB model.
     np.random.seed(prior_seed)
-    x_true = get_alms_from_gsm(freq=ref_freq,lmax=lmax, nside=nside)
+    prior_rng = np.random.default_rng(prior_seed)
+    x_true = get_alms_from_gsm(freq=ref_freq,lmax=lmax, nside=nside, cache_dir=cache_dir)
 
     if incl_RSB == True:
         assert np.any(freq_list != None), \
@@ -1252,7 +1860,7 @@ if __name__ == "__main__":
         # Extract index of the pygsm reference frequency for RSB alm picking
         freq_idx = np.argwhere(ref_freq*1e06==freq_list)[0][0] 
 
-        x_true += RSB_data_model(freq_list=freq_list, lmax=lmax)[freq_idx,:] 
+        x_true += RSB_data_model(freq_list=freq_list, lmax=lmax, freq_idx=freq_idx)
         print("RSB excess is included in the data model")
 
     else:
@@ -1264,25 +1872,27 @@ if __name__ == "__main__":
     # Inverse signal covariance 
     ell_0_idx, _ = get_idx_ml(em=0, ell=0, lmax=lmax)
     min_prior_std = 0.5
-    prior_cov = (0.1 * x_true)**2.
+    prior_cov = np.multiply(x_true, 0.1)
+    np.square(prior_cov, out=prior_cov)
     prior_cov[ell_0_idx] *= a_00_front_factor  # tighter constraints on the monopole 
-    prior_cov[prior_cov < min_prior_std**2.] = min_prior_std**2.
+    np.maximum(prior_cov, min_prior_std**2., out=prior_cov)
 
     # Cosmic variance (if chosen)
     if incl_cosmic_var == True:
         cls = hp.alm2cl(alms2healpy(x_true, lmax))
         f_sky = 1 
         _, ell_idx, _ = get_em_ell_idx(lmax) 
-        cosmic_var = np.zeros(shape=(len(ell_idx)))
-        for i, ell in enumerate(ell_idx):
-            # !! FixMe !!   f_sky is most likely incorrectly placed
-            cosmic_var[i] = 0.1 * np.sqrt(2/(2*ell+1))*cls[ell]*f_sky
+        # !! FixMe !!   f_sky is most likely incorrectly placed
+        cosmic_var = 0.1 * np.sqrt(2/(2*ell_idx+1))*cls[ell_idx]*f_sky
         prior_cov += cosmic_var
 
-    inv_prior_cov = 1/prior_cov
+    inv_prior_cov = np.reciprocal(prior_cov)
     
     # Set the prior mean by the prior variance 
-    a_0 = np.random.randn(x_true.size)*np.sqrt(prior_cov) + x_true # gaussian centered on alms with S variance 
+    std_prior = np.sqrt(prior_cov)
+    a_0 = prior_rng.standard_normal(x_true.size) # gaussian centered on alms with S variance 
+    a_0 *= std_prior
+    a_0 += x_true
     
     # setting the ell=0 mode to be the true value
     a_0[ell_0_idx] = x_true[ell_0_idx]
@@ -1291,50 +1901,65 @@ if __name__ == "__main__":
     np.savez(path+'a_0_'+f'{prior_seed}_'+f'{jobid}', a_0 = a_0)
     
     # Inverse noise covariance and noise on data
-    np.random.seed(data_seed)
+    data_rng = np.random.default_rng(data_seed)
     noise_cov = 0.5 * radiometer_eq(autos@x_true, ants, delta_time, delta_freq)
     inv_noise_cov = 1/noise_cov
-    data_noise = (np.random.randn(noise_cov.size) 
-                  + 1.j*np.random.randn(noise_cov.size)) * np.sqrt(noise_cov) 
+    # Draw the real and imag parts in one call, viewed as complex (re, im) pairs
+    data_noise = data_rng.standard_normal(2*noise_cov.size).view(np.complex128)
+    data_noise *= np.sqrt(noise_cov)
     data_vec = model_true + data_noise
 
-    # Pre-compute the LHS operators, needs defining before the LinearOperator function
-    real_op, imag_op = get_lhs_operators(vis_response=vis_response, inv_noise_cov=inv_noise_cov) 
+    # Contiguous stack of the real and imag parts, so the GEMVs don't act on strided views
+    vis_stack = stack_vis_response(vis_response)
+
+    # Pre-compute the LHS operator
+    lhs_op = get_lhs_operator(vis_stack=vis_stack, inv_noise_cov=inv_noise_cov) 
+    # Data part of the Jacobi preconditioner, constant for all samples
+    lhs_op_diag = np.diag(lhs_op).copy()
+    if precision == 'fp32':
+        lhs_op_fp32 = lhs_op.astype(np.float32)
+    else:
+        lhs_op_fp32 = None
 
-    # Define the inv_signal_cov before calling the LinearOperator function
+    # The prior covariance is used for the Wiener filter and the first sample
     inv_signal_cov = inv_prior_cov.copy()
 
+    # The data term of the RHS is the same for all samples
+    data_term = get_data_rhs_term(data_vec, inv_noise_cov, vis_stack)
+
     # RHS: Wiener filter solution to provide initial guess:
     omega_0_wf = np.zeros_like(a_0)
     omega_1_wf = np.zeros_like(model_true, dtype=np.complex128)
-    rhs_wf = construct_rhs_no_rot(data_vec,
+    rhs_wf = construct_rhs_no_rot(data_term,
                                   inv_noise_cov, 
                                   inv_signal_cov, 
                                   omega_0_wf, 
                                   omega_1_wf, 
                                   a_0, 
-                                  vis_response)
+                                  vis_stack)
     
-    # LHS: Build linear operator object 
-    lhs_shape = (rhs_wf.size, rhs_wf.size)
-    lhs_linear_op = LinearOperator(matvec = lhs_operator,
-                                       shape = lhs_shape)
+    # LHS: Build linear operator object and its Jacobi preconditioner
+    lhs_linear_op = get_lhs_linear_op(lhs_op, inv_signal_cov)
+    lhs_diag = lhs_op_diag + inv_signal_cov
 
     # Get the Wiener Filter solution for initial guess
-    wf_soln, wf_convergence_info = solver(A = lhs_linear_op,
-                                          b = rhs_wf,
-                                          tol = tolerance,
-                                          maxiter = maxiter)
-    initial_guess = wf_soln.copy()
+    wf_soln, wf_convergence_info = pcg(A = lhs_linear_op,
+                                       b = rhs_wf,
+                                       tol = tolerance,
+                                       maxiter = maxiter,
+                                       inv_diag = 1/lhs_diag)
+    initial_guess = wf_soln
 
     # Time for all precomputations
     precomp_time = time.time()-start_time
     print(f'\nprecomputation took:\n{precomp_time} sec.\n')
   
     # Saving all precomputed data
+    # The large operators are saved as raw .npy files, which can be loaded with mmap_mode='r'
+    np.save(path+'vis_response_'+f'{data_seed}_'+f'{jobid}', vis_response)
+    np.save(path+'autos_'+f'{data_seed}_'+f'{jobid}', autos)
+
     np.savez(path+'precomputed_data_'+f'{data_seed}_'+f'{jobid}',
-             vis_response=vis_response,
-             autos=autos,
              x_true=x_true,
              inv_noise_cov=inv_noise_cov,
              min_prior_std=min_prior_std,
@@ -1354,89 +1979,64 @@ if __name__ == "__main__":
              )
 
 
-    avg_iter_time = 0
     # Get alm and cl samples
-    
-    if profile:
-        profiler = cProfile.Profile()
-        profiler.enable()
-
-    save_step = 100 #TODO: make this an cmd-line arg
-    status = -1
-    
-    for sample_no in range(n_samples):
+    # The seeds are derived from (jobid, chain_id), so chain 0 reproduces the 
+    # single-chain run of the same jobid, whatever the number of chains
+    chain_ids = list(range(n_chains))
+    chain_labels = [f'job_{jobid}_chain_{chain_id:03d}_' if n_chains > 1 else '' for chain_id in chain_ids]
+
+    run_chain_kwargs = dict(n_samples = n_samples,
+                            data_term = data_term,
+                            inv_noise_cov = inv_noise_cov,
+                            prior_cov = prior_cov,
+                            a_0 = a_0,
+                            vis_stack = vis_stack,
+                            lhs_op = lhs_op,
+                            lhs_op_diag = lhs_op_diag,
+                            lhs_op_fp32 = lhs_op_fp32,
+                            dense_max_size = dense_max_size,
+                            initial_guess = initial_guess,
+                            lmax = lmax,
+                            tolerance = tolerance,
+                            maxiter = maxiter,
+                            path = path,
+                            jobid = jobid)
+
+    if n_chains == 1:
+        if profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        avg_iter_time = run_chain(chain_ids[0], chain_labels[0], **run_chain_kwargs)
+
+        if profile:
+            profiler.disable()
+            stream = io.StringIO()
+            stats = pstats.Stats(profiler, stream=stream)
+            stats.sort_stats('cumulative')
+            stats.print_stats()
+
+            profile_results = stream.getvalue()
+
+            # Prints to slurm output file:
+            print('cProfile output below: \n %%%%%%%%%%%%% \n')
+            print(profile_results)
+            print('\n %%%%%%%%%%%%%% end of cProfile output')
 
-        sample_start_time = time.time()
-
-        # Set up hdf5 data file
-        if sample_no // save_step > status:
-            savefile = h5py.File(path+f"samples_{sample_no:05d}_to_{sample_no+save_step-1:05d}.hdf5", "a")
-            status = sample_no // save_step
-
-        samplegroup = savefile.create_group(f"sample_{sample_no:05d}")
-
-        # Set random seeds by the sample no. to pass into the sample functions
-        alm_random_seed = 100*jobid + sample_no
-        cl_random_seed = 100*jobid + sample_no
-
-        # get alm samples using prior for the first sample, then C_ell 
-        x_soln, iteration_time = get_alm_samples(data_vec = data_vec,
-                                                 inv_noise_cov = inv_noise_cov,
-                                                 inv_signal_cov = inv_signal_cov,
-                                                 a_0 = a_0,
-                                                 initial_guess = initial_guess,
-                                                 vis_response = vis_response,
-                                                 real_op = real_op,
-                                                 imag_op = imag_op,
-                                                 random_seed = alm_random_seed,
-                                                 tolerance = tolerance,
-                                                 savefile = samplegroup)
-        initial_guess = x_soln.copy()
-
-        # get cl samples
-        cl_samples = get_cl_samples(alms = x_soln,
-                                    lmax = lmax,
-                                    random_seed = cl_random_seed,
-                                    key = sample_no,
-                                    savefile = samplegroup)
-        
-
-        # Change signal_cov to use C_ell values
-        signal_cov = set_signal_cov_by_cl(prior_cov = prior_cov,
-                                          cl_samples = cl_samples,
-                                          lmax = lmax)
-        inv_signal_cov = 1/signal_cov
-            
-        sample_total_time = time.time() - sample_start_time
-        avg_iter_time += sample_total_time
-
-    if profile:
-        profiler.disable()
-        stream = io.StringIO()
-        stats = pstats.Stats(profiler, stream=stream)
-        stats.sort_stats('cumulative')
-        stats.print_stats()
+    else:
+        if profile:
+            print('Warning: cProfile only profiles single-chain runs, set -nchains=1 to profile\n')
 
-        profile_results = stream.getvalue()
+        # The chains are independent, so run them in parallel
+        number_of_cores = min(n_chains, len(os.sched_getaffinity(0)))
+        # Share the cores between the chains, for the BLAS calls within each chain
+        blas_threads = max(1, len(os.sched_getaffinity(0)) // number_of_cores)
+        print(f'Running {n_chains} chains on {number_of_cores} cores with {blas_threads} BLAS threads each\n')
 
-        # Prints to slurm output file:
-        print('cProfile output below: \n %%%%%%%%%%%%% \n')
-        print(profile_results)
-        print('\n %%%%%%%%%%%%%% end of cProfile output')
+        with Pool(number_of_cores, initializer=init_chain_worker, initargs=(run_chain_kwargs, blas_threads)) as pool:
+            chain_iter_times = pool.starmap(run_chain_worker, zip(chain_ids, chain_labels))
+        avg_iter_time = np.mean(chain_iter_times)
 
-  
-    ## Multiprocessing, getting the samples    
-    #number_of_cores = int(os.environ['SLURM_CPUS_PER_TASK'])
-    #print(f'\nSLURM_CPUS_PER_TASK = {number_of_cores}')
-
-    #with Pool(number_of_cores) as pool:
-    #    # issue tasks and process results
-    #    for result in pool.map(samples, range(n_samples)):
-    #        key, iteration_time = result
-    #        avg_iter_time += iteration_time
-    #        #print(f'Iteration {key} completed in {iteration_time:.2f} seconds')
-
-    avg_iter_time /= n_samples
     print(f'average_iter_time:\n{avg_iter_time} sec.\n')
 
     total_time = time.time()-start_time